@@ -47,6 +47,9 @@ if __name__ == '__main__':
     parser.add_argument('--epochs',         default=7,   type=int,   help='the number of epochs')
     parser.add_argument('--lr',             default=1e-4, type=float, help='learning rate')
     parser.add_argument('--no_cuda',        action='store_true')
+    parser.add_argument('--compile',        action='store_true', help='compile the model with torch.compile')
+    parser.add_argument('--mixed_precision', action='store_true', help='run the model under bfloat16 autocast')
+    parser.add_argument('--visual_attn',    action='store_true', help='keep the attention weights of the first layer for visualization')
     # Model parameters
     parser.add_argument('--hidden',         default=256,  type=int,   help='the number of expected features in the transformer')
     parser.add_argument('--n_layers',       default=1,    type=int,   help='the number of heads in the multi-head attention network')
@@ -2,72 +2,134 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from sinkhorn import SinkhornDistance
 from swd import SWD5, SWD7
 import time
 
 class ScaledDotProductAttention(nn.Module):
-    def __init__(self, d_k, attn='trans'):
+    def __init__(self, d_k, attn='trans', n_it=1, max_chunk_size_mb=1024):
         super(ScaledDotProductAttention, self).__init__()
         self.d_k = d_k
         self.swd = SWD7()
+        self.sink = SinkhornDistance(1, max_iter=n_it)
         self.attn = attn
+        self.max_chunk_size_mb = max_chunk_size_mb
 
-    def forward(self, q, k, v, attn_mask, n_it=1, stage='train'):
+    def __setstate__(self, state):
+        # models pickled with torch.save(model) before the chunked Sinkhorn
+        super(ScaledDotProductAttention, self).__setstate__(state)
+        self.__dict__.setdefault('max_chunk_size_mb', 1024)
+
+    def forward(self, q, k, v, attn_mask, stage='train', need_weights=False):
         # |q| : (batch_size, n_heads, q_len, d_k), |k| : (batch_size, n_heads, k_len, d_k), |v| : (batch_size, n_heads, v_len, d_v)
-        # |attn_mask| : (batch_size, n_heads, seq_len(=q_len))
+        # |attn_mask| : (batch_size, 1, 1, k_len), broadcast over heads and queries
 
-        if self.attn == 'trans':
+        if self.attn == 'trans' and need_weights:
             attn_score = torch.matmul(q, k.transpose(-1, -2)) / np.sqrt(self.d_k)
             attn_score.masked_fill_(attn_mask, -1e9)
-            attn_weights = nn.Softmax(dim=-1)(attn_score)
-            attn_weights = attn_weights * attn_weights.shape[-1]
-            output = torch.matmul(attn_weights, v)
+            attn_weights = F.softmax(attn_score, dim=-1)
+            # the weights are rescaled by k_len through the (smaller) output rather than the (q_len, k_len) matrix
+            output = torch.matmul(attn_weights, v) * k.size(-2)
+        elif self.attn == 'trans':
+            # fused kernel (flash / memory-efficient), the (q_len, k_len) weights are never materialized
+            attn_bias = torch.zeros(attn_mask.shape, dtype=q.dtype, device=q.device).masked_fill_(attn_mask, -1e9)
+            output = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias) * k.size(-2)
+            attn_weights = None
         elif self.attn == 'sink':
-            attn_score = torch.matmul(q, k.transpose(-1, -2)) / np.sqrt(self.d_k)
-            attn_score.masked_fill_(attn_mask, -1e9)
-            attn_score_shape = attn_score.shape
-            # |attn_score| : (batch_size, n_heads, q_len, k_len)
-            attn_score = attn_score.view(-1, attn_score_shape[2], attn_score_shape[3])
-            sink = SinkhornDistance(1, max_iter=n_it)
-            attn_weights = sink(attn_score)[0]
-            attn_weights = attn_weights * attn_weights.shape[-1]
+            # checkpointed batch chunks of at most max_chunk_size_mb of scores
+            batch_size, n_heads, q_len, _ = q.shape
+            k_len = k.size(-2)
+            chunk_size = max(1, (self.max_chunk_size_mb * 2**20) // (n_heads * q_len * k_len * 4)) # float32 scores
+            if chunk_size >= batch_size:
+                output, attn_weights = self.sinkhorn_attention(q, k, v, attn_mask, need_weights=need_weights)
+            else:
+                output, attn_weights = None, None
+                for start in range(0, batch_size, chunk_size):
+                    end = start + chunk_size
+                    chunk_args = (q[start:end], k[start:end], v[start:end], attn_mask[start:end])
+                    if torch.is_grad_enabled():
+                        chunk_output, chunk_weights = checkpoint(self.sinkhorn_attention, *chunk_args,
+                                                                 need_weights=need_weights, use_reentrant=False)
+                    else:
+                        chunk_output, chunk_weights = self.sinkhorn_attention(*chunk_args, need_weights=need_weights)
+                    if output is None:
+                        output = chunk_output.new_empty(batch_size, *chunk_output.shape[1:])
+                        if need_weights:
+                            attn_weights = chunk_weights.new_empty(batch_size, *chunk_weights.shape[1:])
+                    output[start:end] = chunk_output
+                    if need_weights:
+                        attn_weights[start:end] = chunk_weights
             # |attn_weights| : (batch_size, n_heads, q_len, k_len)
-            attn_weights = attn_weights.view(attn_score_shape)
-            output = torch.matmul(attn_weights, v)
         elif self.attn == 'swd':
             output, attn_weights = self.swd(q, k, v, attn_mask, stage=stage)
 
         return output, attn_weights
 
+    def sinkhorn_attention(self, q, k, v, attn_mask, need_weights=False):
+        attn_score = torch.matmul(q, k.transpose(-1, -2)) / np.sqrt(self.d_k)
+        attn_score.masked_fill_(attn_mask, -1e9)
+        attn_score_shape = attn_score.shape
+        # |attn_score| : (batch_size, n_heads, q_len, k_len)
+        # Sinkhorn always runs in float32, its log-domain updates lose too much in bfloat16 under autocast
+        attn_weights = self.sink(attn_score.view(-1, attn_score_shape[2], attn_score_shape[3]).float())[0]
+        attn_weights = attn_weights.view(attn_score_shape)
+        output = torch.matmul(attn_weights, v) * attn_score_shape[3]
+
+        return output, (attn_weights if need_weights else None)
+
 class MultiHeadAttention(nn.Module):
     def __init__(self, d_model, n_heads, n_it=1, print_attention=False, attn='trans'):
         super(MultiHeadAttention, self).__init__()
         self.n_heads = n_heads
         self.d_k = self.d_v = d_model//n_heads
 
-        self.WQ = nn.Linear(d_model, d_model)
-        self.WK = nn.Linear(d_model, d_model)
-        self.WV = nn.Linear(d_model, d_model)
-        self.n_it = n_it
-        self.scaled_dot_product_attn = ScaledDotProductAttention(self.d_k, attn=attn)
+        self.W_qkv = nn.Linear(d_model, 3 * d_model)
+        self.scaled_dot_product_attn = ScaledDotProductAttention(self.d_k, attn=attn, n_it=n_it)
         self.linear = nn.Linear(n_heads * self.d_v, d_model)
         self.print_attention = print_attention
+
+    def __setstate__(self, state):
+        # models pickled with torch.save(model) before the fused projection still hold WQ, WK and WV,
+        # and create their SinkhornDistance in forward from n_it
+        super(MultiHeadAttention, self).__setstate__(state)
+        if 'WQ' in self._modules:
+            WQ, WK, WV = (self._modules.pop(name) for name in ('WQ', 'WK', 'WV'))
+            self.W_qkv = nn.Linear(WQ.in_features, 3 * WQ.out_features, device=WQ.weight.device, dtype=WQ.weight.dtype)
+            with torch.no_grad():
+                self.W_qkv.weight.copy_(torch.cat([WQ.weight, WK.weight, WV.weight]))
+                self.W_qkv.bias.copy_(torch.cat([WQ.bias, WK.bias, WV.bias]))
+        n_it = self.__dict__.pop('n_it', 1)
+        if 'sink' not in self.scaled_dot_product_attn._modules:
+            self.scaled_dot_product_attn.sink = SinkhornDistance(1, max_iter=n_it)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # state dicts saved before the fused projection
+        if prefix + 'WQ.weight' in state_dict:
+            for name in ('weight', 'bias'):
+                state_dict[prefix + 'W_qkv.' + name] = torch.cat([state_dict.pop(prefix + W + '.' + name)
+                                                                   for W in ('WQ', 'WK', 'WV')])
+        super(MultiHeadAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
         
-    def forward(self, Q, K, V, attn_mask, stage):
+    def forward(self, Q, K, V, attn_mask, stage, need_weights=False):
         # |Q| : (batch_size, q_len, d_model), |K| : (batch_size, k_len, d_model), |V| : (batch_size, v_len, d_model)
-        # |attn_mask| : (batch_size, seq_len(=q_len), seq_len(=k_len))
+        # |attn_mask| : (batch_size, 1, 1, seq_len(=k_len))
         batch_size = Q.size(0)
 
-        q_heads = self.WQ(Q).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
-        k_heads = self.WK(K).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
-        v_heads = self.WV(V).view(batch_size, -1, self.n_heads, self.d_v).transpose(1, 2)
+        if Q is K and K is V:
+            # self-attention: one GEMM for the three projections
+            qkv = self.W_qkv(Q).view(batch_size, -1, 3, self.n_heads, self.d_k).permute(2, 0, 3, 1, 4).contiguous()
+            q_heads, k_heads, v_heads = qkv.unbind(0)
+        else:
+            W_q, W_k, W_v = self.W_qkv.weight.chunk(3)
+            b_q, b_k, b_v = self.W_qkv.bias.chunk(3)
+            q_heads = F.linear(Q, W_q, b_q).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
+            k_heads = F.linear(K, W_k, b_k).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
+            v_heads = F.linear(V, W_v, b_v).view(batch_size, -1, self.n_heads, self.d_v).transpose(1, 2)
         # |q_heads| : (batch_size, n_heads, q_len, d_k), |k_heads| : (batch_size, n_heads, k_len, d_k), |v_heads| : (batch_size, n_heads, v_len, d_v)
 
-        attn_mask = attn_mask.unsqueeze(1).repeat(1, self.n_heads, 1, 1)
-        # attn_mask = attn_mask.unsqueeze(1).repeat(1, self.n_heads, 1)
-        # |attn_mask| : (batch_size, n_heads, seq_len(=q_len))
-        attn, attn_weights = self.scaled_dot_product_attn(q_heads, k_heads, v_heads, attn_mask, n_it=self.n_it, stage=stage)
+        attn, attn_weights = self.scaled_dot_product_attn(q_heads, k_heads, v_heads, attn_mask, stage=stage,
+                                                             need_weights=need_weights or self.print_attention)
         # |attn| : (batch_size, n_heads, q_len, d_v)
         # |attn_weights| : (batch_size, n_heads, q_len, k_len)
         if self.print_attention:
@@ -109,11 +171,11 @@ class EncoderLayer(nn.Module):
         self.dropout2 = nn.Dropout(p_drop)
         self.layernorm2 = nn.LayerNorm(d_model, eps=1e-6)
 
-    def forward(self, inputs, attn_mask, stage):
+    def forward(self, inputs, attn_mask, stage, need_weights=False):
         # |inputs| : (batch_size, seq_len, d_model)
-        # |attn_mask| : (batch_size, seq_len, seq_len)
+        # |attn_mask| : (batch_size, 1, 1, seq_len)
         
-        attn_outputs, attn_weights = self.mha(inputs, inputs, inputs, attn_mask, stage=stage)
+        attn_outputs, attn_weights = self.mha(inputs, inputs, inputs, attn_mask, stage=stage, need_weights=need_weights)
         attn_outputs = self.dropout1(attn_outputs)
         attn_outputs = self.layernorm1(inputs + attn_outputs)
         # |attn_outputs| : (batch_size, seq_len(=q_len), d_model)
@@ -138,6 +200,9 @@ class TransformerEncoder(nn.Module):
         p_drop     (float)  : dropout value
         d_ff       (int)    : dimension of the feedforward network model
         pad_id     (int)    : pad token id
+        compile    (bool)   : compile the forward pass with torch.compile
+        mixed_precision (bool) : run the forward pass under bfloat16 autocast
+        capture_attn (bool) : return the attention weights of the first layer
 
     Examples:
     >>> encoder = TransformerEncoder(vocab_size=1000, seq_len=512)
@@ -146,71 +211,101 @@ class TransformerEncoder(nn.Module):
     """
     
     def __init__(self, vocab_size, seq_len, d_model=512, n_layers=6, n_heads=8, p_drop=0.1, d_ff=2048, pad_id=0,
-                 n_it=1, print_attention=False, stage='train', attn='trans'):
+                 n_it=1, print_attention=False, stage='train', attn='trans', compile=False,
+                 mixed_precision=False, capture_attn=False):
         super(TransformerEncoder, self).__init__()
         self.pad_id = pad_id
-        self.sinusoid_table = self.get_sinusoid_table(seq_len+1, d_model) # (seq_len+1, d_model)
+        self.register_buffer('sinusoid_table', self.get_sinusoid_table(seq_len+1, d_model), persistent=False) # (seq_len+1, d_model)
+        # position 0 is reserved for padding
+        self.register_buffer('position_ids', torch.arange(1, seq_len+1), persistent=False) # (seq_len)
 
         # layers
         self.embedding = nn.Embedding(vocab_size, d_model)
-        self.pos_embedding = nn.Embedding.from_pretrained(self.sinusoid_table, freeze=True)
         self.layers = nn.ModuleList([EncoderLayer(d_model, n_heads, p_drop, d_ff, n_it=n_it,
                                                   print_attention=print_attention, attn=attn) for _ in range(n_layers)])
         # layers to classify
         self.linear = nn.Linear(d_model, 2)
-        self.softmax = nn.Softmax(dim=-1)
         self.d_model = d_model
         self.dropout = nn.Dropout(p_drop)
+        self.mixed_precision = mixed_precision
+        self.capture_attn = capture_attn
+
+        if compile:
+            # sequences are padded to seq_len, but the last batch of an epoch is smaller and evaluation runs
+            # under no_grad, so let dynamo mark the batch dimension dynamic instead of recompiling for each
+            self.compile(mode='max-autotune', dynamic=None)
+
+    def __setstate__(self, state):
+        # models pickled with torch.save(model) before the sinusoid table became a buffer kept it as a plain
+        # attribute, next to a frozen pos_embedding copy that followed the model to its device
+        super(TransformerEncoder, self).__setstate__(state)
+        if 'sinusoid_table' not in self._buffers:
+            sinusoid_table = self._modules.pop('pos_embedding').weight.detach()
+            del self.__dict__['sinusoid_table']
+            self.register_buffer('sinusoid_table', sinusoid_table, persistent=False)
+            self.register_buffer('position_ids', torch.arange(1, sinusoid_table.size(0), device=sinusoid_table.device),
+                                 persistent=False)
+        self._modules.pop('softmax', None)
+        self.__dict__.setdefault('mixed_precision', False)
+        self.__dict__.setdefault('capture_attn', False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # state dicts saved before the sinusoid table became a non-persistent buffer
+        state_dict.pop(prefix + 'pos_embedding.weight', None)
+        super(TransformerEncoder, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, inputs, stage='train'):
         # |inputs| : (batch_size, seq_len)
-        positions = torch.arange(inputs.size(1), device=inputs.device, dtype=inputs.dtype).repeat(inputs.size(0), 1) + 1
         position_pad_mask = inputs.eq(self.pad_id)
-        positions.masked_fill_(position_pad_mask, 0)
+        positions = torch.where(position_pad_mask, 0, self.position_ids[:inputs.size(1)])
         # |positions| : (batch_size, seq_len)
 
-        outputs = self.embedding(inputs) + self.pos_embedding(positions)
-        # |outputs| : (batch_size, seq_len, d_model)
-
-        attn_pad_mask = self.get_attention_padding_mask(inputs, inputs, self.pad_id)
-        # |attn_pad_mask| : (batch_size, seq_len)
-
-        # outputs = self.dropout(outputs)
-        attention_weights = None
-        # start_time = time.time()
-        for layer in self.layers:
-            outputs, attn_weights = layer(outputs, attn_pad_mask, stage=stage)
+        # matmuls run in bfloat16, autocast keeps layer norm and softmax in float32
+        with torch.autocast(device_type=inputs.device.type, dtype=torch.bfloat16, enabled=self.mixed_precision):
+            outputs = self.embedding(inputs) + self.sinusoid_table[positions]
             # |outputs| : (batch_size, seq_len, d_model)
-            # |attn_weights| : (batch_size, n_heads, seq_len, seq_len)
-            if attention_weights is None and attn_weights is not None:
-                attention_weights = attn_weights.detach().clone()
-        # print('finish one layer in %.4f seconds' % (time.time() - start_time))
-        outputs, _ = torch.max(outputs, dim=1)
-        # |outputs| : (batch_size, d_model)
-        outputs = self.softmax(self.linear(outputs))
-        # |outputs| : (batch_size, 2)
 
-        return outputs, attention_weights
+            # built once and shared by every layer, heads and queries are only ever broadcast
+            attn_pad_mask = self.get_attention_padding_mask(inputs, inputs, self.pad_id)
+            # |attn_pad_mask| : (batch_size, 1, 1, seq_len)
+
+            # outputs = self.dropout(outputs)
+            attention_weights = None
+            # start_time = time.time()
+            for layer in self.layers:
+                # only the first layer is asked for its weights, the others can use the fused kernels
+                need_weights = self.capture_attn and attention_weights is None
+                outputs, attn_weights = layer(outputs, attn_pad_mask, stage=stage, need_weights=need_weights)
+                # |outputs| : (batch_size, seq_len, d_model)
+                # |attn_weights| : (batch_size, n_heads, seq_len, seq_len)
+                if need_weights and attn_weights is not None:
+                    attention_weights = attn_weights.detach()
+            # print('finish one layer in %.4f seconds' % (time.time() - start_time))
+            outputs = outputs.amax(dim=1)
+            # |outputs| : (batch_size, d_model)
+            # raw logits, the trainer's CrossEntropyLoss applies the log-softmax
+            outputs = self.linear(outputs)
+            # |outputs| : (batch_size, 2)
+
+        # float32 logits so the loss is not computed in bfloat16
+        return outputs.float(), attention_weights
 
     def get_attention_padding_mask(self, q, k, pad_id):
-        attn_pad_mask = k.eq(pad_id).unsqueeze(1).repeat(1, q.size(1), 1)
-        # |attn_pad_mask| : (batch_size, q_len, k_len)
-
-        # attn_pad_mask = k.eq(pad_id)
-        # |attn_pad_mask| : (batch_size, q_len)
+        # only the keys are masked, so the mask is left to broadcast over heads and queries
+        # rather than being materialized as (batch_size, n_heads, q_len, k_len)
+        attn_pad_mask = k.eq(pad_id).unsqueeze(1).unsqueeze(1)
+        # |attn_pad_mask| : (batch_size, 1, 1, k_len)
 
         return attn_pad_mask
 
     def get_sinusoid_table(self, seq_len, d_model):
-        def get_angle(pos, i, d_model):
-            return pos / np.power(10000, (2 * (i//2)) / d_model)
-        
-        sinusoid_table = np.zeros((seq_len, d_model))
-        for pos in range(seq_len):
-            for i in range(d_model):
-                if i%2 == 0:
-                    sinusoid_table[pos, i] = np.sin(get_angle(pos, i, d_model))
-                else:
-                    sinusoid_table[pos, i] = np.cos(get_angle(pos, i, d_model))
-
-        return torch.FloatTensor(sinusoid_table)
\ No newline at end of file
+        pos = np.arange(seq_len)[:, None]
+        i = np.arange(d_model)[None, :]
+        angles = pos / np.power(10000, (2 * (i//2)) / d_model)
+        # |angles| : (seq_len, d_model)
+
+        sinusoid_table = np.empty((seq_len, d_model), dtype=np.float32)
+        sinusoid_table[:, 0::2] = np.sin(angles[:, 0::2])
+        sinusoid_table[:, 1::2] = np.cos(angles[:, 1::2])
+
+        return torch.from_numpy(sinusoid_table)
\ No newline at end of file
@@ -183,15 +183,13 @@ class TransformerEncoder(nn.Module):
         return attn_pad_mask
 
     def get_sinusoid_table(self, seq_len, d_model):
-        def get_angle(pos, i, d_model):
-            return pos / np.power(10000, (2 * (i//2)) / d_model)
-        
-        sinusoid_table = np.zeros((seq_len, d_model))
-        for pos in range(seq_len):
-            for i in range(d_model):
-                if i%2 == 0:
-                    sinusoid_table[pos, i] = np.sin(get_angle(pos, i, d_model))
-                else:
-                    sinusoid_table[pos, i] = np.cos(get_angle(pos, i, d_model))
-
-        return torch.FloatTensor(sinusoid_table)
\ No newline at end of file
+        pos = np.arange(seq_len)[:, None]
+        i = np.arange(d_model)[None, :]
+        angles = pos / np.power(10000, (2 * (i//2)) / d_model)
+        # |angles| : (seq_len, d_model)
+
+        sinusoid_table = np.empty((seq_len, d_model), dtype=np.float32)
+        sinusoid_table[:, 0::2] = np.sin(angles[:, 0::2])
+        sinusoid_table[:, 1::2] = np.cos(angles[:, 1::2])
+
+        return torch.from_numpy(sinusoid_table)
\ No newline at end of file
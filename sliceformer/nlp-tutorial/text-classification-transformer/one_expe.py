@@ -130,6 +130,8 @@ parser.add_argument("--n_it", type=int, default=3)
 parser.add_argument("--seed", type=int, default=0)
 parser.add_argument('--attn', type=str, default='swd', choices=['trans', 'sink', 'swd'])
 parser.add_argument('--visual_attn', type=bool, default=False)
+parser.add_argument('--compile', action='store_true', help='compile the model with torch.compile')
+parser.add_argument('--mixed_precision', action='store_true', help='run the model under bfloat16 autocast')
 args = parser.parse_args()
 
 
@@ -1,3 +1,4 @@
+import math
 import torch
 import torch.nn as nn
 
@@ -22,36 +23,30 @@ class SinkhornDistance(nn.Module):
         batch_size = C.shape[0]
 
         # both marginals are fixed with equal weights
-        mu = torch.empty(batch_size, x_points, dtype=torch.float,
-                         requires_grad=False, device=C.device).fill_(1.0 / x_points).squeeze()
-        nu = torch.empty(batch_size, y_points, dtype=torch.float,
-                         requires_grad=False, device=C.device).fill_(1.0 / y_points).squeeze()
+        log_mu = -math.log(x_points)
+        log_nu = -math.log(y_points)
 
-        if mu.dim() < 2:
-            mu = mu.view(-1, 1)
-
-        if nu.dim() < 2:
-            nu = nu.view(-1, 1)
-
-        u = torch.zeros_like(mu)
-        v = torch.zeros_like(nu)
+        u = torch.zeros(batch_size, x_points, dtype=C.dtype, device=C.device)
+        v = torch.zeros(batch_size, y_points, dtype=C.dtype, device=C.device)
 
         # Stopping criterion
         thresh = 1e-12
 
-        # Sinkhorn iterations
+        # Sinkhorn iterations, u = mu / (K v) and v = nu / (K^T u) in the log domain for the whole batch:
+        # the u (resp. v) terms cancel out of M, so each update is one broadcast add and one logsumexp
         for i in range(self.max_iter):
             if i % 2 == 0:
                 u1 = u  # useful to check the update
-                u = self.eps * (torch.log(mu) - torch.logsumexp(self.M(C, u, v), dim=-1)) + u
+                u = self.eps * (log_mu - torch.logsumexp((c + v.unsqueeze(-2)) / self.eps, dim=-1))
                 err = (u - u1).abs().sum(-1).mean()
             else:
-                v = self.eps * (torch.log(nu) - torch.logsumexp(self.M(C, u, v).transpose(-2, -1), dim=-1)) + v
+                v = self.eps * (log_nu - torch.logsumexp((c + u.unsqueeze(-1)) / self.eps, dim=-2))
                 v = v.detach().requires_grad_(False)
                 v[v > 9 * 1e8] = 0.0
                 v = v.detach().requires_grad_(True)
 
-            if err.item() < thresh:
+            # no point syncing with the device for the stopping test after the last iteration
+            if i < self.max_iter - 1 and err.item() < thresh:
                 break
 
         U, V = u, v
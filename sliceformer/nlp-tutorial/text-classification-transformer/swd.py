@@ -185,7 +185,7 @@ class SWD7(nn.Module):
 
     def forward(self, q, k, v, attn_mask, stage='train'):
         # |q| : (batch_size, n_heads, q_len, d_k), |k| : (batch_size, n_heads, k_len, d_k)
-        # |attn_mask| : (batch_size, n_heads, q_len, k_len)
+        # |attn_mask| : (batch_size, 1, 1, k_len)
         batch_size, n_heads, q_len, d_k = q.shape
         _, _, k_len, _ = k.shape
 
@@ -209,8 +209,8 @@ class SWD7(nn.Module):
         new_v[:, :, 0, :] = values
         new_v.scatter_(-2, indices.unsqueeze(-2), v_cls.unsqueeze(-2))
         out = new_v
-
-        out = out.masked_fill(attn_mask[:,:,0,:].unsqueeze(-1).repeat(1, 1, 1, d_k), 0)
+        # new_v is already a copy of v, the padded tokens can be zeroed in place
+        out.masked_fill_(attn_mask[:, :, 0, :].unsqueeze(-1), 0)
         # |c_q| : (batch_size, n_heads, q_len, d_k)
         # c_q = c.gather(-2, q_rank) / d_k
         # v_q = v.gather(-2, q_rank)
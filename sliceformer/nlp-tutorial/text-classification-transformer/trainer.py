@@ -3,8 +3,13 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import time
+import warnings
 from model import TransformerEncoder
 
+# TF32 tensor cores for the float32 matmuls and convolutions
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
 def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
 
@@ -26,14 +31,22 @@ class Trainer:
                                         d_ff        = args.ffn_hidden,
                                         pad_id      = self.pad_id,
                                         n_it = n_it,
-                                        attn = args.attn
+                                        attn = args.attn,
+                                        compile = args.compile,
+                                        mixed_precision = args.mixed_precision,
+                                        capture_attn = args.visual_attn
                                    )
         print('Number of parameters of the model is %d' % count_parameters(model))
 
         for layer in model.children():
             if hasattr(layer, 'reset_parameters'):
                 layer.reset_parameters()
-        model = torch.nn.DataParallel(model)
+        if not args.compile:
+            model = torch.nn.DataParallel(model)
+        elif self.device == 'cuda' and torch.cuda.device_count() > 1:
+            # DataParallel replicas would all go through the compiled call of the original module
+            warnings.warn('--compile disables DataParallel, training on a single GPU out of %d'
+                          % torch.cuda.device_count())
         self.model = model
         self.model.to(self.device)
 
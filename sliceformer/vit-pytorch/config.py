@@ -21,6 +21,8 @@ config = {
     'gpu': 'cuda:4',
     'num_workers': 8,
     'seed': 0,
+    'compile': False, # torch.compile the model (vit only)
+    'mixed_precision': False, # bfloat16 autocast (vit only)
     
     'attn': 'swd', #choices=['trans', 'sink', 'swd']
     'model': 'vit', # choices=['vit', 'ema', 'Haar']
@@ -18,6 +18,8 @@ from utils import create_logger, seed_everything, save_checkpoint, load_state_di
 from config import config
 
 torch.set_printoptions(profile='full', precision=6)
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 
 args = config
 
@@ -221,7 +223,8 @@ def main(args=args):
     if args['model'] == 'vit':
         model = ViT(image_size=args['size'], patch_size=args['ps'], num_classes=args['num_classes'], channels=args['channels'],
                          emb_dropout=args['emb_dropout'], dropout=args['dropout'], dim=args['dim'], depth=args['n_layers'], heads=args['n_heads'], mlp_dim=args['mlp_dim'],
-                         max_iter=args['n_it'], eps=1, attn=args['attn']).to(device)
+                         max_iter=args['n_it'], eps=1, attn=args['attn'], compile=args['compile'],
+                         mixed_precision=args['mixed_precision'], capture_attn=args['visual_attn']).to(device)
     elif args['model'] == 'Haar':
         model = ViT_Haar(image_size=args['size'], patch_size=args['ps'], num_classes=args['num_classes'], channels=args['channels'],
                          emb_dropout=args['emb_dropout'], dropout=args['dropout'], dim=args['dim'], depth=args['n_layers'], heads=args['n_heads'], mlp_dim=args['mlp_dim'],
@@ -16,7 +16,7 @@ setup(
   ],
   install_requires=[
     'einops>=0.3',
-    'torch>=1.6',
+    'torch>=2.2',
     'torchvision'
   ],
   classifiers=[
@@ -1,9 +1,9 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from vit_pytorch.sinkhorn import SinkhornDistance
 from vit_pytorch.swd import *
-from einops import rearrange, repeat
 from einops.layers.torch import Rearrange
 
 # helpers
@@ -37,7 +37,8 @@ class FeedForward(nn.Module):
 perm = torch.randperm(64)
 
 class Attention(nn.Module):
-    def __init__(self, dim, heads = 8, dim_head = 64, dropout = 0., max_iter=3, eps=1, attn='trans', layer_idx=None):
+    def __init__(self, dim, heads = 8, dim_head = 64, dropout = 0., max_iter=3, eps=1, attn='trans', layer_idx=None,
+                 max_chunk_size_mb=1024):
         super().__init__()
         inner_dim = dim_head *  heads
         project_out = not (heads == 1 and dim_head == dim)
@@ -45,6 +46,7 @@ class Attention(nn.Module):
         self.heads = heads
         self.scale = dim_head ** -0.5
         self.max_iter = max_iter
+        self.max_chunk_size_mb = max_chunk_size_mb
         self.swd = SWD15()
         self.sink = SinkhornDistance(eps=eps, max_iter=max_iter)
         self.attend = nn.Softmax(dim = -1)
@@ -66,7 +68,7 @@ class Attention(nn.Module):
         else:
             self.col_descend = perm[int(dim_head/2):]
             
-    def forward(self, x, training=True):
+    def forward(self, x, training=True, need_weights=True):
         # with torch.no_grad():
         #     self.to_qkv.weight.div_(torch.norm(self.to_qkv.weight, dim=1, keepdim=True))
         
@@ -74,39 +76,50 @@ class Attention(nn.Module):
         cls_indices = None
         
         if self.attn == 'trans':
-            qkv = self.to_qkv(x).chunk(3, dim = -1)
-            q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = self.heads), qkv)
-            dots = torch.matmul(q, k.transpose(-1, -2)) * self.scale
+            b, n, _ = x.shape
+            qkv = self.to_qkv(x).reshape(b, n, 3, self.heads, -1).permute(2, 0, 3, 1, 4).contiguous()
+            q, k, v = qkv[0], qkv[1], qkv[2]
 
             # unsort(softmax(sorted(x)))
+            # dots = torch.matmul(q, k.transpose(-1, -2)) * self.scale
             # dots_sorted, dots_indices = dots.sort(dim=-1)
             # attn = self.attend(dots_sorted)
             # _, dots_rank = dots_indices.sort(dim=-1)
             # attn = attn.gather(dim=-1, index=dots_rank)
-            
-            # softmax(x)
-            attn = self.attend(dots)
-            
-            # F.softmax(x)
-            # attn = F.softmax(dots, dim=-1, dtype=torch.bfloat16).to(torch.float)
-            
-            attn = self.dropout(attn)
-            out = torch.matmul(attn, v)
+
+            # softmax(x), fused kernel: scale, softmax and dropout without materializing the n x n matrix
+            out = F.scaled_dot_product_attention(q, k, v, dropout_p = self.dropout.p if self.training else 0.)
             attn = out
             # U, S, Vh = torch.linalg.svd(out)
             # print(S[0,0])
-            out = rearrange(out, 'b h n d -> b n (h d)')
+            out = out.transpose(1, 2).reshape(b, n, -1)
         elif self.attn == 'sink':
-            qkv = self.to_qkv(x).chunk(3, dim = -1)
-            q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = self.heads), qkv)
-            dots = torch.matmul(q, k.transpose(-1, -2)) * self.scale
-            dots_former_shape = dots.shape
-            dots = dots.view(-1, dots_former_shape[2], dots_former_shape[3])
-            attn = self.sink(dots)[0]
-            attn = attn * attn.shape[-1]
-            attn = attn.view(dots_former_shape)
-            out = torch.matmul(attn, v)
-            out = rearrange(out, 'b h n d -> b n (h d)')
+            b, n, _ = x.shape
+            qkv = self.to_qkv(x).reshape(b, n, 3, self.heads, -1).permute(2, 0, 3, 1, 4).contiguous()
+            q, k, v = qkv[0], qkv[1], qkv[2]
+            # checkpointed batch chunks of at most max_chunk_size_mb of plans
+            chunk_size = max(1, (self.max_chunk_size_mb * 2**20) // (self.heads * n * n * 4)) # float32 plans
+            if chunk_size >= b:
+                out, attn = self.sinkhorn_attention(q, k, v, need_weights=need_weights)
+            else:
+                out, attn = None, None
+                for start in range(0, b, chunk_size):
+                    end = start + chunk_size
+                    if torch.is_grad_enabled():
+                        chunk_out, chunk_attn = checkpoint(self.sinkhorn_attention, q[start:end], k[start:end],
+                                                           v[start:end], need_weights=need_weights,
+                                                           use_reentrant=False)
+                    else:
+                        chunk_out, chunk_attn = self.sinkhorn_attention(q[start:end], k[start:end], v[start:end],
+                                                                        need_weights=need_weights)
+                    if out is None:
+                        out = chunk_out.new_empty(b, *chunk_out.shape[1:])
+                        if need_weights:
+                            attn = chunk_attn.new_empty(b, *chunk_attn.shape[1:])
+                    out[start:end] = chunk_out
+                    if need_weights:
+                        attn[start:end] = chunk_attn
+            out = out.transpose(1, 2).reshape(b, n, -1)
         elif self.attn == 'swd':
             # qkv = self.to_qkv(x)
             # v = rearrange(qkv, 'b n (h d) -> b h n d', h = self.heads)
@@ -134,9 +147,21 @@ class Attention(nn.Module):
             
         return self.to_out(out), attn, cls_indices
 
+    def sinkhorn_attention(self, q, k, v, need_weights=True):
+        n = q.size(-2)
+        dots = torch.matmul(q, k.transpose(-1, -2)) * self.scale
+        dots_former_shape = dots.shape
+        dots = dots.view(-1, dots_former_shape[2], dots_former_shape[3])
+        attn = self.sink(dots.float())[0]
+        attn = attn.view(dots_former_shape)
+        # rescale by n on the output rather than on the n x n plan
+        out = torch.matmul(attn, v) * n
+        return out, (attn if need_weights else None)
+
 class Transformer(nn.Module):
-    def __init__(self, dim, depth, heads, dim_head, mlp_dim, dropout = 0.1, max_iter=1, eps=1, attn='trans'):
+    def __init__(self, dim, depth, heads, dim_head, mlp_dim, dropout = 0.1, max_iter=1, eps=1, attn='trans', capture_attn=False):
         super().__init__()
+        self.capture_attn = capture_attn
         self.layers = nn.ModuleList([])
         for idx, _ in enumerate(range(depth)):
             self.layers.append(nn.ModuleList([
@@ -153,10 +178,12 @@ class Transformer(nn.Module):
             # else:
             #     attn_x, attn_matrix = attn(x, training=training)
             #     x = attn_x + x
-            attn_x, attn_matrix, cls_indices = attn(x, training=training)
+            attn_x, attn_matrix, cls_indices = attn(x, training=training, need_weights=self.capture_attn)
             x = attn_x + x
             x = ff(x) + x
-            attn_weights.append(attn_matrix.detach().clone().cpu())
+            if self.capture_attn:
+                # .cpu() already copies, no need to clone on the device first; float32 for numpy under autocast
+                attn_weights.append(attn_matrix.detach().float().cpu())
             
         return x, attn_weights, cls_indices
 
@@ -182,7 +209,8 @@ class Transformer_only_Att(nn.Module):
 
 class ViT(nn.Module):
     def __init__(self, *, image_size, patch_size, num_classes, dim, depth, heads, mlp_dim, pool = 'cls', channels = 3,
-                 dim_head = 64, dropout = 0., emb_dropout = 0., max_iter=1, eps=1, attn='trans'):
+                 dim_head = 64, dropout = 0., emb_dropout = 0., max_iter=1, eps=1, attn='trans', compile=False,
+                 mixed_precision=False, capture_attn=False):
         super().__init__()
         image_height, image_width = pair(image_size)
         patch_height, patch_width = pair(patch_size)
@@ -202,7 +230,8 @@ class ViT(nn.Module):
         self.cls_token = nn.Parameter(torch.randn(1, 1, dim))
         self.dropout = nn.Dropout(emb_dropout)
 
-        self.transformer = Transformer(dim, depth, heads, dim_head, mlp_dim, dropout, max_iter=max_iter, eps=eps, attn=attn)
+        self.transformer = Transformer(dim, depth, heads, dim_head, mlp_dim, dropout, max_iter=max_iter, eps=eps, attn=attn,
+                                       capture_attn=capture_attn)
 
         self.pool = pool
         self.to_latent = nn.Identity()
@@ -212,33 +241,42 @@ class ViT(nn.Module):
             nn.Linear(dim, num_classes)
         )
 
-    def forward(self, img, training=True):
-        x = self.to_patch_embedding(img)
-        b, n, _ = x.shape
-
-        cls_tokens = repeat(self.cls_token, '() n d -> b n d', b = b)
-        x = torch.cat((cls_tokens, x), dim=1)
-        x += self.pos_embedding[:, :(n + 1)]
-        x = self.dropout(x)
-
-        # indices_rand = torch.randperm(x.size(dim=-2) - 1)
-        # x_0 = x[:, 0, :].unsqueeze(-2)
-        # x_b = x[:, 1:, :][:, indices_rand, :]
-        # x = torch.cat([x_0, x_b], dim=-2)
-
-        trans_x, attn_weights, cls_indices = self.transformer(x, training=training)
-        x = trans_x
-
-        if self.pool == 'mean':
-            x = x.mean(dim = 1)
-        elif cls_indices is not None:
-            cls_indices = cls_indices.unsqueeze(1).repeat(1, 1, x.size(-1))
-            x = x.gather(dim=-2, index=cls_indices).squeeze()
-        else:
-            x = x[:, 0]
+        self.mixed_precision = mixed_precision
 
-        x = self.to_latent(x)
-        return self.mlp_head(x), attn_weights
+        if compile:
+            # the last batch of an epoch is smaller, let dynamo mark the batch dimension dynamic on recompile
+            self.compile(mode = 'max-autotune', dynamic = None)
+
+    def forward(self, img, training=True):
+        with torch.autocast(device_type = img.device.type, dtype = torch.bfloat16, enabled = self.mixed_precision):
+            x = self.to_patch_embedding(img)
+            b, n, _ = x.shape
+
+            cls_tokens = self.cls_token.expand(b, -1, -1)
+            x = torch.cat((cls_tokens, x), dim=1)
+            x += self.pos_embedding[:, :(n + 1)]
+            x = self.dropout(x)
+
+            # indices_rand = torch.randperm(x.size(dim=-2) - 1)
+            # x_0 = x[:, 0, :].unsqueeze(-2)
+            # x_b = x[:, 1:, :][:, indices_rand, :]
+            # x = torch.cat([x_0, x_b], dim=-2)
+
+            trans_x, attn_weights, cls_indices = self.transformer(x, training=training)
+            x = trans_x
+
+            if self.pool == 'mean':
+                x = x.mean(dim = 1)
+            elif cls_indices is not None:
+                cls_indices = cls_indices.unsqueeze(1).repeat(1, 1, x.size(-1))
+                x = x.gather(dim=-2, index=cls_indices).squeeze()
+            else:
+                x = x[:, 0]
+
+            x = self.to_latent(x)
+            x = self.mlp_head(x)
+
+        return x.float(), attn_weights
 
 
 class ViT_only_Att(nn.Module):